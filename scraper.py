@@ -1,17 +1,65 @@
 from __future__ import annotations
 
-import json
-from datetime import datetime, timezone
+import argparse
+import os
+import re
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import cloudscraper
+import lxml.html
+import orjson
 import requests
-from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from requests.adapters import HTTPAdapter
 
 URL = "https://competitions.ffbb.com/ligues/guy/comites/0973/clubs/guy0973007/equipes/200000005178873/classement"
 OUTPUT_FILE = Path("data.json")
 REQUEST_TIMEOUT = 25
+MAX_WORKERS = 8
+# Matches the daily cron in .github/workflows/scrape.yaml
+SCHEDULE_INTERVAL = timedelta(days=1)
+# Resolved once at import; the scraper is a short-lived process so the offset can't go stale
+LOCAL_TZ = datetime.now(timezone.utc).astimezone().tzinfo
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36"
+    ),
+    "Accept-Language": "fr,fr-FR;q=0.9,en;q=0.8",
+    "Accept-Encoding": "br, gzip",
+}
+CACHE_MAX_AGE = re.compile(r"\bmax-age=(\d+)")
+MAX_DELTA_SECONDS = 2**31
+CHALLENGE_STATUSES = (403, 503)
+CHALLENGE_MARKERS = (b"Just a moment...", b"cf-chl-")
+
+# Shared across calls so repeated fetches reuse the keep-alive connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+_CLOUDSCRAPER_LOCK = threading.Lock()
+
+# FFBB standings columns, in table order; missing trailing cells become ""
+STANDING_KEYS = ("rank", "name", "points", "played", "won", "lost")
+_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_LOWER = "abcdefghijklmnopqrstuvwxyz"
+_TH_TEXT = f"translate(., '{_UPPER}', '{_LOWER}')"
+TABLE_ROWS = etree.XPath(".//tr")
+ROW_CELLS = etree.XPath("./td")
+CELL_STRINGS = etree.XPath(".//text()", smart_strings=False)
+# Tables whose headers mention points and a team/rank column.
+TARGET_TABLES = etree.XPath(
+    f"//table[.//th[contains({_TH_TEXT}, 'pts')]"
+    f" and .//th[contains({_TH_TEXT}, 'equipe')"
+    f" or contains({_TH_TEXT}, 'rang')"
+    f" or contains({_TH_TEXT}, 'classement')]]"
+)
 
 
 def log(message: str) -> None:
@@ -21,77 +69,218 @@ def log(message: str) -> None:
 def load_existing_payload() -> dict:
     if OUTPUT_FILE.exists():
         try:
-            return json.loads(OUTPUT_FILE.read_text(encoding="utf-8"))
+            return orjson.loads(OUTPUT_FILE.read_bytes())
         except Exception:
             return {}
     return {}
 
 
-def fetch_html() -> Tuple[Optional[str], Optional[str]]:
-    """
-    Uses cloudscraper to better handle anti-bot (different from plain requests).
-    Falls back to requests if needed.
-    """
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36"
-        ),
-        "Accept-Language": "fr,fr-FR;q=0.9,en;q=0.8",
+def conditional_headers(previous_payload: dict) -> dict:
+    headers = {}
+    if previous_payload.get("etag"):
+        headers["If-None-Match"] = previous_payload["etag"]
+    if previous_payload.get("last_modified"):
+        headers["If-Modified-Since"] = previous_payload["last_modified"]
+    return headers
+
+
+def freshness_deadline(response: requests.Response) -> Optional[datetime]:
+    """When the server says the page may be reused until, from Cache-Control or Expires."""
+    cache_control = response.headers.get("Cache-Control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return None
+
+    now = datetime.now(LOCAL_TZ)
+    match = CACHE_MAX_AGE.search(cache_control)
+    if match:
+        age = response.headers.get("Age", "0")
+        # RFC 9111: delta-seconds above 2**31 are treated as 2**31
+        max_age = min(int(match.group(1)), MAX_DELTA_SECONDS)
+        return now + timedelta(seconds=max_age - (min(int(age), MAX_DELTA_SECONDS) if age.isdigit() else 0))
+
+    expires = response.headers.get("Expires")
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).astimezone(LOCAL_TZ)
+        except (TypeError, ValueError, OverflowError):
+            return None  # e.g. "Expires: 0", which means already expired
+    return None
+
+
+def is_fresh(previous_payload: dict) -> bool:
+    if previous_payload.get("status") != "ok":
+        return False
+    return is_still_fresh(previous_payload.get("fresh_until"), datetime.now(LOCAL_TZ))
+
+
+def is_still_fresh(fresh_until: Optional[str], at: datetime) -> bool:
+    if not fresh_until:
+        return False
+    try:
+        return at < datetime.fromisoformat(fresh_until)
+    except ValueError:
+        return False
+
+
+def read_response(response: requests.Response) -> Tuple[Optional[str], Optional[str], dict]:
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fresh_until": None,
     }
+    deadline = freshness_deadline(response)
+    if deadline is not None:
+        # Stored as text so it compares equal to the value read back from data.json
+        validators["fresh_until"] = deadline.isoformat()
+    if response.status_code == 304:
+        return None, None, validators
+    response.encoding = response.encoding or "utf-8"
+    return response.text, None, validators
+
+
+@lru_cache(maxsize=None)
+def _build_cloudscraper() -> requests.Session:
+    # Imported lazily: cloudscraper is heavy and only needed behind a Cloudflare challenge
+    import cloudscraper
 
     scraper = cloudscraper.create_scraper(browser={"browser": "chrome", "platform": "windows", "mobile": False})
+    scraper.headers.update(HEADERS)
+    return scraper
+
+
+def get_cloudscraper() -> requests.Session:
+    # lru_cache alone lets concurrent fetch_all workers each build one
+    with _CLOUDSCRAPER_LOCK:
+        return _build_cloudscraper()
+
+
+def is_challenge(response: requests.Response) -> bool:
+    if response.status_code in CHALLENGE_STATUSES:
+        return True
+    return any(marker in response.content for marker in CHALLENGE_MARKERS)
+
+
+def fetch_html(
+    url: str, previous_payload: dict, use_cloudscraper: bool = True
+) -> Tuple[Optional[str], Optional[str], dict]:
+    """
+    Uses plain requests first and only escalates to cloudscraper when the
+    response looks like a Cloudflare anti-bot challenge.
+
+    The request is conditional on the ETag / Last-Modified stored with the
+    previous payload: on 304 Not Modified both html and error are None.
+    """
+    headers = conditional_headers(previous_payload)
+
     try:
-        response = scraper.get(URL, headers=headers, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        response.encoding = response.encoding or "utf-8"
-        return response.text, None
-    except Exception as exc:  # broad on purpose, cloudscraper can raise runtime errors
-        log(f"Cloudscraper failed: {exc}; trying plain requests.")
+        response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if not is_challenge(response):
+            response.raise_for_status()
+            return read_response(response)
+    except requests.RequestException as exc:
+        return None, f"Network error: {exc}", {}
+
+    if not use_cloudscraper:
+        return None, f"Cloudflare challenge (HTTP {response.status_code}) and cloudscraper is disabled", {}
 
+    log(f"Got a Cloudflare challenge (HTTP {response.status_code}); retrying with cloudscraper.")
     try:
-        response = requests.get(URL, headers=headers, timeout=REQUEST_TIMEOUT)
+        response = get_cloudscraper().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        response.encoding = response.encoding or "utf-8"
-        return response.text, None
-    except requests.RequestException as exc:
-        return None, f"Network error: {exc}"
+        return read_response(response)
+    except Exception as exc:  # broad on purpose, cloudscraper can raise runtime errors
+        return None, f"Cloudscraper failed: {exc}", {}
+
+
+def fetch_all(
+    previous_payloads: Dict[str, dict], use_cloudscraper: bool = True
+) -> Dict[str, Tuple[Optional[str], Optional[str], dict]]:
+    """
+    Fetches several pages concurrently over the shared session.
+    Keys are URLs, values the previous payload for that page; results
+    are keyed the same way and shaped like fetch_html's.
+    """
+    if not previous_payloads:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(previous_payloads))) as executor:
+        futures = {
+            url: executor.submit(fetch_html, url, payload, use_cloudscraper)
+            for url, payload in previous_payloads.items()
+        }
+        return {url: future.result() for url, future in futures.items()}
+
+
+def cell_text(cell: lxml.html.HtmlElement) -> str:
+    # Join text nodes with a space, then collapse all Unicode whitespace (&nbsp;, U+202F, ...)
+    return " ".join(" ".join(CELL_STRINGS(cell)).split())
 
 
-def clean_text(tag: Tag) -> str:
-    return " ".join(tag.get_text(" ", strip=True).split())
+def find_table_end(lowered: str, start: int) -> int:
+    """Index just past the </table> closing the table opened at start, or -1."""
+    depth, pos = 0, start
+    while True:
+        next_open = lowered.find("<table", pos)
+        next_close = lowered.find("</table>", pos)
+        if next_close == -1:
+            return -1
+        if next_open != -1 and next_open < next_close:
+            depth += 1
+            pos = next_open + len("<table")
+        else:
+            depth -= 1
+            pos = next_close + len("</table>")
+            if depth == 0:
+                return pos
+
+
+def extract_table_region(html: str) -> Optional[str]:
+    """
+    Cheap string scan for the first <table>...</table> that mentions "pts",
+    so the parser does not have to build the rest of the page.
+    """
+    lowered = html.lower()
+    start = lowered.find("<table")
+    while start != -1:
+        end = find_table_end(lowered, start)
+        if end == -1:
+            return None
+        if lowered.find("pts", start, end) != -1:
+            return html[start:end]
+        start = lowered.find("<table", end)
+    return None
 
 
-def find_target_table(soup: BeautifulSoup) -> Optional[Tag]:
-    for table in soup.find_all("table"):
-        headers = [clean_text(th).lower() for th in table.find_all("th")]
-        header_blob = " ".join(headers)
-        if "pts" in header_blob and ("equipe" in header_blob or "rang" in header_blob or "classement" in header_blob):
-            return table
+def find_target_table(html: str) -> Optional[lxml.html.HtmlElement]:
+    # Try the sliced region first, fall back to the full page if the heuristic misses
+    for source in (extract_table_region(html), html):
+        if source:
+            tables = TARGET_TABLES(lxml.html.fromstring(source))
+            if tables:
+                return tables[0]
     return None
 
 
 def parse_standings(html: str) -> Tuple[List[dict], Optional[str]]:
-    soup = BeautifulSoup(html, "lxml")
-    table = find_target_table(soup)
+    if not html.strip():
+        return [], "Empty response body"
+
+    try:
+        table = find_target_table(html)
+    except (etree.ParserError, ValueError) as exc:
+        return [], f"Could not parse HTML: {exc}"
+
     if table is None:
         return [], "Standings table not found"
 
     standings: List[dict] = []
-    for row in table.find_all("tr"):
-        cells = row.find_all("td")
+    for row in TABLE_ROWS(table):
+        cells = ROW_CELLS(row)
         if len(cells) < 3:
             continue
 
-        entry = {
-            "rank": clean_text(cells[0]),
-            "name": clean_text(cells[1]),
-            "points": clean_text(cells[2]),
-            "played": clean_text(cells[3]) if len(cells) > 3 else "",
-            "won": clean_text(cells[4]) if len(cells) > 4 else "",
-            "lost": clean_text(cells[5]) if len(cells) > 5 else "",
-        }
-        standings.append(entry)
+        values = [cell_text(cell) for cell in cells[: len(STANDING_KEYS)]]
+        values += [""] * (len(STANDING_KEYS) - len(values))
+        standings.append(dict(zip(STANDING_KEYS, values)))
 
     if not standings:
         return [], "No standings rows parsed"
@@ -99,11 +288,13 @@ def parse_standings(html: str) -> Tuple[List[dict], Optional[str]]:
     return standings, None
 
 
-def build_payload(standings: List[dict], warning: Optional[str]) -> dict:
-    now = datetime.now(timezone.utc).astimezone()
+def build_payload(source: str, standings: List[dict], warning: Optional[str], validators: dict) -> dict:
     return {
-        "updated_at": now.isoformat(),
-        "source": URL,
+        "updated_at": datetime.now(LOCAL_TZ),
+        "etag": validators.get("etag"),
+        "last_modified": validators.get("last_modified"),
+        "fresh_until": validators.get("fresh_until"),
+        "source": source,
         "standings": standings,
         "standing_count": len(standings),
         "status": "ok" if warning is None else "degraded",
@@ -111,21 +302,75 @@ def build_payload(standings: List[dict], warning: Optional[str]) -> dict:
     }
 
 
+def is_unchanged(payload: dict, previous_payload: dict) -> bool:
+    """True when payload only differs from previous_payload by timestamps not worth writing."""
+    if any(
+        value != previous_payload.get(key)
+        for key, value in payload.items()
+        if key not in ("updated_at", "fresh_until")
+    ):
+        return False
+    # A moved cache deadline is only worth a write when it still holds at the next scheduled run
+    fresh_until = payload["fresh_until"]
+    next_run = datetime.now(LOCAL_TZ) + SCHEDULE_INTERVAL
+    return fresh_until == previous_payload.get("fresh_until") or not is_still_fresh(fresh_until, next_run)
+
+
 def save_payload(payload: dict) -> None:
-    OUTPUT_FILE.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    # Write a sibling temp file and swap it in, so readers never see a partial data.json
+    tmp_file = OUTPUT_FILE.with_name(f"{OUTPUT_FILE.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_file, "wb") as handle:
+            handle.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+            handle.flush()
+            os.fsync(handle.fileno())
+        if OUTPUT_FILE.exists():
+            os.chmod(tmp_file, stat.S_IMODE(OUTPUT_FILE.stat().st_mode))
+        os.replace(tmp_file, OUTPUT_FILE)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
     log(f"Wrote {OUTPUT_FILE} ({payload['standing_count']} entries, status={payload['status']}).")
 
 
-def main() -> None:
-    log("Starting scrape (cloudscraper)")
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Scrape the FFBB standings into data.json.")
+    parser.add_argument(
+        "--no-cloudscraper",
+        dest="use_cloudscraper",
+        action="store_false",
+        help="never fall back to cloudscraper, even on a Cloudflare challenge",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    log("Starting scrape")
 
     previous_payload = load_existing_payload()
-    html, fetch_error = fetch_html()
+    if is_fresh(previous_payload):
+        log(f"Source said its page stays fresh until {previous_payload['fresh_until']}; skipping fetch")
+        return
+
+    html, fetch_error, validators = fetch_html(URL, previous_payload, args.use_cloudscraper)
     standings: List[dict] = []
     parse_error: Optional[str] = None
 
-    if html:
+    if html is None and fetch_error is None:
+        log("Source not modified (HTTP 304)")
+        # Same standings as last time, but the 304 may carry a new cache deadline
+        standings = previous_payload.get("standings", [])
+        validators = {
+            "etag": validators.get("etag") or previous_payload.get("etag"),
+            "last_modified": validators.get("last_modified") or previous_payload.get("last_modified"),
+            "fresh_until": validators.get("fresh_until"),
+        }
+    elif html is not None:
         standings, parse_error = parse_standings(html)
+        if parse_error:
+            # Don't let a later 304 pin standings we could not parse
+            validators = {}
 
     warning = fetch_error or parse_error
 
@@ -133,9 +378,15 @@ def main() -> None:
     if not standings and previous_payload.get("standings"):
         standings = previous_payload["standings"]
         warning = warning or "Using last known standings (new scrape failed)"
+        if fetch_error:
+            # Still the same standings, so the previous validators still apply
+            validators = previous_payload
 
-    payload = build_payload(standings, warning)
-    save_payload(payload)
+    payload = build_payload(URL, standings, warning, validators)
+    if is_unchanged(payload, previous_payload):
+        log(f"Standings unchanged; keeping {OUTPUT_FILE} as is")
+    else:
+        save_payload(payload)
 
     if warning:
         log(f"Completed with warning: {warning}")